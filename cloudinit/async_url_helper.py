@@ -0,0 +1,330 @@
+# Copyright 2015 Canonical Ltd.
+# This file is part of cloud-init.  See LICENCE file for license information.
+#
+# vi: ts=4 expandtab
+
+"""Asyncio flavours of :func:`cloudinit.url_helper.read_url` and
+:func:`cloudinit.url_helper.wait_any_url`.
+
+The HTTP/1.1 client used here is built on top of asyncio streams, using
+only the standard library. This module needs Python 3.5 or newer and
+it is not imported by :mod:`cloudinit.url_helper`, so it is only loaded
+by the code which actually uses it.
+"""
+
+import asyncio
+import email.parser
+import ssl
+
+from six.moves.urllib.parse import urlencode
+from six.moves.urllib.parse import urljoin
+
+from six.moves import http_client
+
+from cloudinit import logging
+from cloudinit import url_helper
+from cloudinit import version
+
+
+LOG = logging.getLogger(__name__)
+
+# Same as the default used by requests.
+MAX_REDIRECTS = 30
+
+_REDIRECT_CODES = frozenset([
+    http_client.MOVED_PERMANENTLY,
+    http_client.FOUND,
+    http_client.SEE_OTHER,
+    http_client.TEMPORARY_REDIRECT,
+    308,
+])
+_NO_BODY_CODES = frozenset([
+    http_client.NO_CONTENT,
+    http_client.NOT_MODIFIED,
+])
+
+
+class AsyncResponse(object):
+    """A response read by :func:`read_url_async`.
+
+    This has the same interface as :class:`cloudinit.url_helper.
+    RequestsResponse`, the whole body being already read.
+    """
+
+    def __init__(self, url, status_code, headers, contents):
+        self.url = url
+        self.status_code = status_code
+        self.headers = headers
+        self.contents = contents
+
+    @property
+    def encoding(self):
+        params = dict(self.headers.get_params(header='content-type') or [])
+        return params.get('charset', 'utf-8')
+
+    def ok(self, redirects_ok=False):
+        upper = http_client.MULTIPLE_CHOICES
+        if redirects_ok:
+            upper = http_client.BAD_REQUEST
+        return self.status_code >= http_client.OK and self.status_code < upper
+
+    def __str__(self):
+        return self.contents.decode(self.encoding, 'replace')
+
+
+def _get_ssl_context(ssl_details):
+    ssl_details = ssl_details or {}
+    context = ssl.create_default_context(
+        cafile=ssl_details.get('ca_certs') or None)
+    if 'cert_file' in ssl_details:
+        context.load_cert_chain(ssl_details['cert_file'],
+                                ssl_details.get('key_file'))
+    return context
+
+
+async def _wait(awaitable, timeout):
+    # Each socket operation is bounded by the timeout, which mirrors
+    # what requests is doing for connecting and reading.
+    if timeout is None:
+        return await awaitable
+    return await asyncio.wait_for(awaitable, timeout)
+
+
+async def _read_headers(reader, timeout):
+    lines = []
+    while True:
+        line = await _wait(reader.readline(), timeout)
+        if not line:
+            raise http_client.IncompleteRead(b''.join(lines))
+        if line in (b'\r\n', b'\n'):
+            break
+        lines.append(line)
+    parser = email.parser.Parser(_class=http_client.HTTPMessage)
+    return parser.parsestr(b''.join(lines).decode('iso-8859-1'))
+
+
+async def _read_chunked(reader, timeout):
+    chunks = []
+    while True:
+        line = await _wait(reader.readline(), timeout)
+        size = int(line.split(b';', 1)[0].strip() or b'0', 16)
+        if size == 0:
+            # Skip any trailers.
+            await _read_headers(reader, timeout)
+            return b''.join(chunks)
+        chunks.append(await _wait(reader.readexactly(size), timeout))
+        await _wait(reader.readline(), timeout)
+
+
+async def _read_body(reader, method, status_code, headers, timeout):
+    if method == 'HEAD' or status_code < 200 or status_code in _NO_BODY_CODES:
+        return b''
+    if 'chunked' in headers.get('Transfer-Encoding', '').lower():
+        return await _read_chunked(reader, timeout)
+    length = headers.get('Content-Length')
+    if length is not None:
+        return await _wait(reader.readexactly(int(length)), timeout)
+    return await _wait(reader.read(), timeout)
+
+
+async def _request(method, url, data, headers, timeout, ssl_details):
+    parsed_url = url_helper.urlparse(url)
+    if parsed_url.scheme == 'https':
+        ssl_context = _get_ssl_context(ssl_details)
+    else:
+        ssl_context = None
+    _, host, port = url_helper._get_pool_key(url)
+    reader, writer = await _wait(
+        asyncio.open_connection(host, port, ssl=ssl_context), timeout)
+    try:
+        path = url_helper.urlunparse(('', '', parsed_url.path or '/',
+                                      parsed_url.params, parsed_url.query,
+                                      ''))
+        lines = ['%s %s HTTP/1.1' % (method, path),
+                 'Host: %s' % parsed_url.netloc,
+                 'Connection: close']
+        lines.extend('%s: %s' % header for header in headers.items())
+        if data is not None:
+            lines.append('Content-Length: %s' % len(data))
+        head = ('\r\n'.join(lines) + '\r\n\r\n').encode('iso-8859-1')
+        writer.write(head + (data or b''))
+        await _wait(writer.drain(), timeout)
+
+        status_line = await _wait(reader.readline(), timeout)
+        try:
+            _, status_code = status_line.split(None, 2)[:2]
+            status_code = int(status_code)
+        except ValueError:
+            raise http_client.BadStatusLine(status_line)
+        response_headers = await _read_headers(reader, timeout)
+        contents = await _read_body(reader, method, status_code,
+                                    response_headers, timeout)
+    finally:
+        writer.close()
+    return AsyncResponse(url, status_code, response_headers, contents)
+
+
+async def _request_with_redirects(method, url, data, headers, timeout,
+                                  ssl_details, allow_redirects):
+    for _ in range(MAX_REDIRECTS + 1):
+        response = await _request(method, url, data, headers, timeout,
+                                  ssl_details)
+        location = response.headers.get('Location')
+        if (not allow_redirects or not location or
+                response.status_code not in _REDIRECT_CODES):
+            return response
+        url = urljoin(url, location)
+        if (response.status_code == http_client.SEE_OTHER or
+                (method == 'POST' and response.status_code in
+                 (http_client.MOVED_PERMANENTLY, http_client.FOUND))):
+            method, data = 'GET', None
+            headers.pop('Content-Type', None)
+        LOG.debug("Redirected to %s (%s)", url, response.status_code)
+    raise ValueError("Exceeded %s redirects" % MAX_REDIRECTS)
+
+
+def _prepare_data(data, headers):
+    if isinstance(data, dict):
+        headers.setdefault('Content-Type',
+                           'application/x-www-form-urlencoded')
+        data = urlencode(data)
+    if not isinstance(data, bytes):
+        data = str(data).encode('utf-8')
+    return data
+
+
+async def read_url_async(url, data=None, timeout=None, retries=0,
+                         headers=None, ssl_details=None,
+                         check_status=True, allow_redirects=True):
+    """Fetch a url (or post to one) with the given options.
+
+    This is the coroutine counterpart of
+    :func:`cloudinit.url_helper.read_url`, taking the same arguments
+    and raising the same :class:`cloudinit.url_helper.UrlError`.
+    It returns an :class:`AsyncResponse`.
+    """
+    url = url_helper._clean_url(url)
+    method = 'GET'
+    request_headers = dict((name.title(), value)
+                           for name, value in (headers or {}).items())
+    request_headers.setdefault('User-Agent',
+                               'Cloud-Init/%s' % version.version_string())
+    request_headers.setdefault('Accept', '*/*')
+    if data:
+        method = 'POST'
+        data = _prepare_data(data, request_headers)
+    else:
+        data = None
+    if timeout is not None:
+        timeout = max(float(timeout), 0)
+
+    attempts = max(int(retries or 0), 0) + 1
+    for attempt in range(1, attempts + 1):
+        try:
+            response = await _request_with_redirects(
+                method, url, data, dict(request_headers), timeout,
+                ssl_details, allow_redirects)
+        except (OSError, ValueError, asyncio.TimeoutError,
+                asyncio.IncompleteReadError,
+                http_client.HTTPException) as e:
+            if attempt == attempts:
+                raise url_helper.UrlError(e)
+            LOG.debug("Failed fetching %s (%s), retrying", url, e)
+            continue
+        if (response.status_code < http_client.BAD_REQUEST or
+                attempt == attempts):
+            break
+        # Same as url_helper._Retry, every status >= 400 is retried.
+        LOG.debug("Got status %s from %s, retrying",
+                  response.status_code, url)
+
+    if check_status and response.status_code >= http_client.BAD_REQUEST:
+        cause = ValueError("%s Error for url: %s"
+                           % (response.status_code, response.url))
+        raise url_helper.UrlError(cause, code=response.status_code,
+                                  headers=response.headers)
+    LOG.debug("Read from %s (%s, %sb)", url, response.status_code,
+              len(response.contents))
+    return response
+
+
+async def _check_url_async(url, timeout):
+    try:
+        response = await read_url_async(url, timeout=timeout,
+                                        check_status=False)
+    except url_helper.UrlError as e:
+        return None, "request error [%s]" % e, e
+    except Exception as e:
+        return None, "unexpected error [%s]" % e, e
+    return url_helper._check_response(response)
+
+
+async def wait_any_url_async(urls, max_wait=None, timeout=None,
+                             status_cb=None, sleep_time=1,
+                             exception_cb=None):
+    """Wait for one of many urls to respond correctly.
+
+    This is the coroutine counterpart of
+    :func:`cloudinit.url_helper.wait_any_url`. All the urls are tried
+    at the same time and the first one which responds correctly wins,
+    the remaining requests being cancelled.
+
+    This will return a tuple of the first url which succeeded and the
+    response object, or ``None`` if *max_wait* passed.
+    """
+    loop = asyncio.get_event_loop()
+    start_time = loop.time()
+
+    if not status_cb:
+        status_cb = LOG.debug
+
+    def timeup():
+        return (max_wait is None or max_wait <= 0 or
+                loop.time() - start_time > max_wait)
+
+    def report_failure(url, reason, url_exc):
+        time_taken = int(loop.time() - start_time)
+        status_msg = "Calling '%s' failed [%s/%ss]: %s" % (url,
+                                                           time_taken,
+                                                           max_wait,
+                                                           reason)
+        status_cb(status_msg)
+        if exception_cb:
+            exception_cb(msg=status_msg, exception=url_exc)
+
+    async def check(url, timeout):
+        return url, await _check_url_async(url, timeout)
+
+    loop_n = 0
+    while True:
+        sleep_time = int(loop_n / 5) + 1
+        wait = None
+        if loop_n != 0:
+            remaining = start_time + max_wait - loop.time()
+            wait = max(remaining, 0)
+            if timeout and timeout > remaining:
+                # shorten timeout to not run way over max_time
+                timeout = int(remaining)
+        tasks = [asyncio.ensure_future(check(url, timeout)) for url in urls]
+        try:
+            for next_done in asyncio.as_completed(tasks, timeout=wait):
+                url, (response, reason, url_exc) = await next_done
+                if response is not None:
+                    return url, response
+                report_failure(url, reason, url_exc)
+        except asyncio.TimeoutError:
+            LOG.debug("Gave up waiting for %s urls",
+                      len([task for task in tasks if not task.done()]))
+        finally:
+            for task in tasks:
+                task.cancel()
+
+        if timeup():
+            break
+
+        loop_n = loop_n + 1
+        LOG.debug("Please wait %s seconds while we wait to try again",
+                  sleep_time)
+        await asyncio.sleep(sleep_time)
+
+    return None
@@ -0,0 +1,147 @@
+# Copyright 2015 Canonical Ltd.
+# This file is part of cloud-init.  See LICENCE file for license information.
+#
+# vi: ts=4 expandtab
+
+"""Time budgets and jittered backoff schedules for retrying operations.
+
+A :class:`Deadline` can be shared by several calls (for instance all the
+requests made while loading a data source), so that they all draw from
+the same time budget. A :class:`Backoff` computes the delays between
+retries, optionally jittered, so that many instances booting at the same
+time don't retry in lockstep.
+"""
+
+import random
+import time
+
+try:
+    from time import monotonic as now
+except ImportError:  # pragma: nocover
+    from time import time as now
+
+from cloudinit import logging
+
+
+LOG = logging.getLogger(__name__)
+
+NO_JITTER = 'none'
+FULL_JITTER = 'full'
+DECORRELATED_JITTER = 'decorrelated'
+JITTERS = (NO_JITTER, FULL_JITTER, DECORRELATED_JITTER)
+
+
+def full_jitter(delay, rand=random.uniform):
+    """Get a random delay between 0 and *delay*."""
+    return rand(0, delay)
+
+
+class Deadline(object):
+    """A time budget, which can be shared between multiple calls.
+
+    :param budget:
+        The number of seconds available from the creation of
+        this object. ``None`` means that there is no limit.
+    :param clock:
+        A function returning the current time, in seconds
+        (a monotonic clock by default).
+    """
+
+    def __init__(self, budget=None, clock=None):
+        self._clock = clock or now
+        self.budget = budget
+        self.start = self._clock()
+
+    def elapsed(self):
+        """Get the number of seconds spent since the deadline was set."""
+        return self._clock() - self.start
+
+    def remaining(self):
+        """Get the number of seconds left, ``None`` if unlimited."""
+        if self.budget is None:
+            return None
+        return max(self.budget - self.elapsed(), 0)
+
+    def expired(self):
+        """Check if the whole budget was spent."""
+        if self.budget is None:
+            return False
+        return self.budget <= 0 or self.elapsed() > self.budget
+
+    def trim(self, timeout):
+        """Shorten *timeout* so that it does not go past the deadline."""
+        remaining = self.remaining()
+        if remaining is None:
+            return timeout
+        if timeout is None:
+            return remaining
+        return min(timeout, remaining)
+
+    def __repr__(self):
+        return "Deadline(budget=%s, remaining=%s)" % (self.budget,
+                                                      self.remaining())
+
+
+class Backoff(object):
+    """Compute the delays between consecutive retries.
+
+    The delays grow exponentially from *base* seconds, up to *cap*
+    seconds, with the given *jitter* applied on top:
+
+    * ``none``: the delays are ``base * 2 ** attempt``
+    * ``full``: a random delay between 0 and the exponential delay
+    * ``decorrelated``: a random delay between *base* and three times
+      the previous delay (this spreads the retries better than full
+      jitter, while still growing on average)
+
+    :param deadline:
+        A :class:`Deadline`; the delays are trimmed to the
+        remaining budget.
+    """
+
+    def __init__(self, base=1, cap=30, jitter=FULL_JITTER, deadline=None,
+                 rand=random.uniform):
+        if jitter not in JITTERS:
+            raise ValueError("Invalid jitter %r, expected one of %s"
+                             % (jitter, ", ".join(JITTERS)))
+        self.base = base
+        self.cap = cap
+        self.jitter = jitter
+        self.deadline = deadline
+        self._rand = rand
+        self.reset()
+
+    def reset(self):
+        """Start the schedule from the first delay again."""
+        self.attempt = 0
+        self._previous = self.base
+
+    def next_delay(self):
+        """Get the delay to wait before the next retry."""
+        exponential = min(self.cap, self.base * 2 ** self.attempt)
+        if self.jitter == FULL_JITTER:
+            delay = full_jitter(exponential, rand=self._rand)
+        elif self.jitter == DECORRELATED_JITTER:
+            delay = min(self.cap, self._rand(self.base, self._previous * 3))
+        else:
+            delay = exponential
+        self.attempt += 1
+        self._previous = delay
+        if self.deadline is not None:
+            delay = self.deadline.trim(delay)
+        return delay
+
+    def sleep(self):
+        """Sleep for the next delay.
+
+        This returns ``False`` (without sleeping) if the deadline
+        already expired, ``True`` otherwise.
+        """
+        if self.deadline is not None and self.deadline.expired():
+            return False
+        delay = self.next_delay()
+        if delay > 0:
+            LOG.debug("Please wait %.2f seconds while we wait to try again",
+                      delay)
+            time.sleep(delay)
+        return True
@@ -8,10 +8,12 @@ import os
 import posixpath
 import re
 
+from cloudinit import backoff
 from cloudinit import exceptions
 from cloudinit.osys import base
 from cloudinit.sources import base as base_source
 from cloudinit.sources.openstack import base as baseopenstack
+from cloudinit import url_cache
 from cloudinit import url_helper
 
 
@@ -23,7 +25,11 @@ VERSION_REGEX = re.compile('^\d{4}-\d{2}-\d{2}$')
 
 
 class HttpOpenStackSource(baseopenstack.BaseOpenStackSource):
-    """Class for exporting the HTTP OpenStack data source."""
+    """Class for exporting the HTTP OpenStack data source.
+
+    All the metadata fetched while loading the data source share the same
+    time budget, *max_wait*, instead of having it for each of them.
+    """
 
     datasource_config = {
         'max_wait': 120,
@@ -31,8 +37,14 @@ class HttpOpenStackSource(baseopenstack.BaseOpenStackSource):
         'metadata_url': 'http://169.254.169.254/',
         'post_password_version': '2013-04-04',
         'retries': 3,
+        # Directory for caching the metadata between boots,
+        # the metadata is not cached when this is missing.
+        'cache_dir': None,
     }
 
+    # The time budget of the current load, if any.
+    _deadline = None
+
     @staticmethod
     def _enable_metadata_access(metadata_url):
         if IS_WINDOWS:
@@ -63,12 +75,22 @@ class HttpOpenStackSource(baseopenstack.BaseOpenStackSource):
 
         return versions
 
+    @property
+    def _http_cache(self):
+        cache_dir = self._config.get('cache_dir')
+        if cache_dir:
+            return url_cache.HttpCache(cache_dir)
+
     def _get_data(self, path):
         norm_path = self._path_join(self._config['metadata_url'], path)
         LOG.debug('Getting metadata from: %s', norm_path)
         response = url_helper.wait_any_url([norm_path],
                                            timeout=self._config['timeout'],
-                                           max_wait=self._config['max_wait'])
+                                           max_wait=self._config['max_wait'],
+                                           cache=self._http_cache,
+                                           deadline=self._deadline,
+                                           backoff=backoff.Backoff(
+                                               deadline=self._deadline))
         if response:
             _, request = response
             return base_source.APIResponse(request.contents,
@@ -91,14 +113,18 @@ class HttpOpenStackSource(baseopenstack.BaseOpenStackSource):
     def load(self):
         metadata_url = self._config['metadata_url']
         self._enable_metadata_access(metadata_url)
-        super(HttpOpenStackSource, self).load()
-
+        self._deadline = backoff.Deadline(self._config['max_wait'])
         try:
-            self._get_meta_data()
-            return True
-        except Exception:
-            LOG.warning('Metadata not found at URL %r', metadata_url)
-            return False
+            super(HttpOpenStackSource, self).load()
+
+            try:
+                self._get_meta_data()
+                return True
+            except Exception:
+                LOG.warning('Metadata not found at URL %r', metadata_url)
+                return False
+        finally:
+            self._deadline = None
 
     def can_update_password(self):
         """Check if the password can be posted for the current data source."""
@@ -0,0 +1,24 @@
+# Copyright 2015 Canonical Ltd.
+# This file is part of cloud-init.  See LICENCE file for license information.
+#
+# vi: ts=4 expandtab
+
+"""Benchmarks, to be run against local stand-in servers.
+
+Each benchmark is a module, runnable with ``python -m``.
+"""
+
+try:
+    from time import monotonic as now  # noqa
+except ImportError:  # pragma: nocover
+    from time import time as now  # noqa
+
+
+def print_table(headers, rows):
+    """Print the given *rows* as a simple aligned table."""
+    rows = [headers] + [[str(column) for column in row] for row in rows]
+    widths = [max(len(row[index]) for row in rows)
+              for index in range(len(headers))]
+    for row in rows:
+        print('  '.join(column.ljust(width)
+                        for column, width in zip(row, widths)))
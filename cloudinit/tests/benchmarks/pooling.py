@@ -0,0 +1,57 @@
+# Copyright 2015 Canonical Ltd.
+# This file is part of cloud-init.  See LICENCE file for license information.
+#
+# vi: ts=4 expandtab
+
+"""Compare :func:`cloudinit.url_helper.read_url` with and without pooling.
+
+Run with ``python -m cloudinit.tests.benchmarks.pooling``.
+"""
+
+import argparse
+
+from cloudinit.tests import benchmarks
+from cloudinit.tests import http_server
+from cloudinit import url_helper
+
+
+def run(server, count, pooled):
+    url_helper.close_sessions()
+    server.reset()
+    start = benchmarks.now()
+    for _ in range(count):
+        url_helper.read_url(server.url('/meta_data.json'))
+        if not pooled:
+            # This is what read_url used to do after each request.
+            url_helper.close_sessions()
+    elapsed = benchmarks.now() - start
+    url_helper.close_sessions()
+    return (server.connections, len(server.requests), elapsed)
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--requests', type=int, default=50,
+                        help='number of requests to make')
+    parser.add_argument('--connect-latency', type=float, default=0.005,
+                        help='seconds spent setting up a connection, '
+                             'mimicking a network handshake')
+    args = parser.parse_args(args)
+
+    routes = {'/meta_data.json': b'{"uuid": "fake"}'}
+    rows = []
+    with http_server.LocalHTTPServer(
+            routes, connect_latency=args.connect_latency) as server:
+        for pooled in (False, True):
+            connections, requests, elapsed = run(server, args.requests,
+                                                 pooled)
+            rows.append(('pooled' if pooled else 'unpooled',
+                         connections, requests,
+                         '%.2f' % (elapsed * 1000),
+                         '%.2f' % (elapsed * 1000 / requests)))
+    benchmarks.print_table(
+        ('mode', 'connections', 'requests', 'total ms', 'ms/request'), rows)
+
+
+if __name__ == '__main__':
+    main()
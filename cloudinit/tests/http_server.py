@@ -0,0 +1,157 @@
+# Copyright 2015 Canonical Ltd.
+# This file is part of cloud-init.  See LICENCE file for license information.
+#
+# vi: ts=4 expandtab
+
+"""A small, real (socket based) HTTP server, to be used by tests/benchmarks.
+
+Unlike ``httpretty``, this server listens on a local port, so it can be
+used for observing the real socket behaviour of the HTTP client code
+(connection reuse, timeouts and so on).
+"""
+
+import socket
+import threading
+import time
+
+from six.moves import BaseHTTPServer
+from six.moves import socketserver
+
+
+class _ThreadedHTTPServer(socketserver.ThreadingMixIn,
+                          BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class _RequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    # Needed for keep-alive connections.
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        # Headers and body are written separately, avoid having the
+        # body delayed by Nagle's algorithm on keep-alive connections.
+        self.connection.setsockopt(socket.IPPROTO_TCP,
+                                   socket.TCP_NODELAY, 1)
+        self.server.owner._connection_made()
+
+    def log_message(self, format, *args):
+        """Stub, the requests are not logged on stderr."""
+
+    def _handle(self):
+        self.server.owner._request_made(self)
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+        status, headers, content = self.server.owner.respond(
+            self.command, self.path, self.headers, body)
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        if 'Transfer-Encoding' not in headers:
+            self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(content)
+
+    do_GET = do_POST = do_PUT = do_HEAD = _handle
+
+
+class LocalHTTPServer(object):
+    """A threaded HTTP server, listening on the loopback interface.
+
+    :param routes:
+        A dictionary mapping request paths to either a body
+        (bytes), or a tuple of ``(status, body)`` or
+        ``(status, headers, body)``. Unknown paths get a 404.
+        The body is sent as is when a ``Transfer-Encoding`` header
+        is given, otherwise a ``Content-Length`` header is added.
+    :param connect_latency:
+        Seconds to wait after a connection is accepted, before
+        serving any request on it. This can be used for mimicking
+        the cost of a network handshake.
+    :param latency:
+        Seconds to wait before answering each request.
+
+    The server is started and stopped by using it as a context manager::
+
+        with LocalHTTPServer({'/': b'hello'}) as server:
+            read_url(server.url('/'))
+    """
+
+    def __init__(self, routes=None, connect_latency=0, latency=0,
+                 host='127.0.0.1'):
+        self.routes = dict(routes or {})
+        self.connect_latency = connect_latency
+        self.latency = latency
+        self.host = host
+        self.requests = []
+        self.connections = 0
+        self._lock = threading.Lock()
+        self._server = None
+        self._thread = None
+
+    @property
+    def port(self):
+        return self._server.server_address[1]
+
+    @property
+    def base_url(self):
+        return 'http://%s:%s/' % (self.host, self.port)
+
+    def url(self, path=''):
+        """Get the absolute url for the given *path*."""
+        return self.base_url + path.lstrip('/')
+
+    def reset(self):
+        """Forget about the connections and requests seen until now."""
+        with self._lock:
+            self.connections = 0
+            self.requests = []
+
+    def _connection_made(self):
+        with self._lock:
+            self.connections += 1
+        if self.connect_latency:
+            time.sleep(self.connect_latency)
+
+    def _request_made(self, handler):
+        with self._lock:
+            self.requests.append((handler.command, handler.path))
+
+    def respond(self, method, path, headers, body):
+        """Get the ``(status, headers, body)`` for the given request.
+
+        Subclasses can override this for serving dynamic content.
+        """
+        if self.latency:
+            time.sleep(self.latency)
+        route = self.routes.get(path)
+        if route is None:
+            return 404, {}, b'not found'
+        if not isinstance(route, tuple):
+            return 200, {}, route
+        if len(route) == 2:
+            return route[0], {}, route[1]
+        return route
+
+    def start(self):
+        self._server = _ThreadedHTTPServer((self.host, 0), _RequestHandler)
+        self._server.owner = self
+        self._thread = threading.Thread(target=self._server.serve_forever,
+                                        kwargs={'poll_interval': 0.05})
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
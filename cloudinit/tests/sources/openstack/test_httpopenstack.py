@@ -13,6 +13,7 @@ from cloudinit.sources.openstack import httpopenstack
 from cloudinit import tests
 from cloudinit.tests.util import LogSnatcher
 from cloudinit.tests.util import mock
+from cloudinit import url_cache
 from cloudinit import url_helper
 
 
@@ -188,6 +189,7 @@ class TestHttpOpenStackSource(tests.TestCase):
             response = self._source.load()
 
         self.assertEqual(expected, response)
+        self.assertIsNone(self._source._deadline)
         mock_enable_metadata_access.assert_called_once_with(
             self._source._config['metadata_url'])
         mock_load.assert_called_once_with()
@@ -249,3 +251,13 @@ class TestHttpOpenStackSource(tests.TestCase):
         self.assertIsInstance(result, base.APIResponse)
         self.assertEqual('test', str(result))
         self.assertEqual(b'test', result.buffer)
+
+    def test__http_cache(self):
+        self.assertIsNone(self._source._http_cache)
+
+        with mock.patch.dict(self._source._config,
+                             {'cache_dir': mock.sentinel.cache_dir}):
+            cache = self._source._http_cache
+
+        self.assertIsInstance(cache, url_cache.HttpCache)
+        self.assertEqual(mock.sentinel.cache_dir, cache.directory)
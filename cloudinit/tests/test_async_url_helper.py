@@ -0,0 +1,234 @@
+# Copyright 2015 Canonical Ltd.
+# This file is part of cloud-init.  See LICENCE file for license information.
+#
+# vi: ts=4 expandtab
+
+import asyncio
+
+from cloudinit import async_url_helper
+from cloudinit.tests import TestCase
+from cloudinit.tests.util import mock
+from cloudinit import url_helper
+
+
+class AsyncHTTPServer(object):
+    """A local HTTP stand-in, running on the loop of the test.
+
+    *routes* maps paths to a list of ``(status, headers, body)``
+    responses, which are served in order (the last one is repeated).
+    """
+
+    def __init__(self, loop, routes):
+        self.loop = loop
+        self.routes = routes
+        self.requests = []
+        self._server = None
+        self._handlers = set()
+
+    def url(self, path):
+        port = self._server.sockets[0].getsockname()[1]
+        return 'http://127.0.0.1:%s%s' % (port, path)
+
+    async def _handle(self, reader, writer):
+        self._handlers.add(asyncio.current_task())
+        request_line = await reader.readline()
+        method, path, _ = request_line.decode().split()
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b''):
+                break
+            name, value = line.decode().split(':', 1)
+            headers[name.strip().lower()] = value.strip()
+        body = await reader.readexactly(int(headers.get('content-length',
+                                                        0)))
+        self.requests.append((method, path, headers, body))
+
+        responses = self.routes.get(path, [(404, {}, b'not found')])
+        status, response_headers, content = responses[0]
+        if len(responses) > 1:
+            responses.pop(0)
+        if callable(content):
+            content = await content()
+        lines = ['HTTP/1.1 %s Whatever' % status]
+        lines.extend('%s: %s' % item for item in response_headers.items())
+        if 'Transfer-Encoding' not in response_headers:
+            lines.append('Content-Length: %s' % len(content))
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode() + content)
+        await writer.drain()
+        writer.close()
+
+    def __enter__(self):
+        self._server = self.loop.run_until_complete(
+            asyncio.start_server(self._handle, '127.0.0.1', 0))
+        return self
+
+    def __exit__(self, *args):
+        if self._handlers:
+            for handler in self._handlers:
+                handler.cancel()
+            self.loop.run_until_complete(
+                asyncio.wait(self._handlers))
+            self._handlers.clear()
+        self._server.close()
+        self.loop.run_until_complete(self._server.wait_closed())
+
+
+class AsyncUrlHelperTest(TestCase):
+
+    def setUp(self):
+        super(AsyncUrlHelperTest, self).setUp()
+        self.loop = asyncio.new_event_loop()
+        self.addCleanup(self.loop.close)
+
+    def _server(self, routes):
+        server = AsyncHTTPServer(self.loop, routes)
+        server.__enter__()
+        self.addCleanup(server.__exit__)
+        return server
+
+    def _read_url(self, *args, **kwargs):
+        return self.loop.run_until_complete(
+            async_url_helper.read_url_async(*args, **kwargs))
+
+    def test_read_url(self):
+        server = self._server({'/': [(200, {}, b'it worked!')]})
+
+        response = self._read_url(server.url('/'))
+
+        self.assertEqual(b'it worked!', response.contents)
+        self.assertEqual(url_helper.OK, response.status_code)
+        self.assertTrue(response.ok())
+        self.assertEqual('it worked!', str(response))
+        _, _, headers, _ = server.requests[0]
+        self.assertTrue(headers['user-agent'].startswith('Cloud-Init/'))
+
+    def test_read_url_custom_headers_and_post(self):
+        server = self._server({'/password': [(200, {}, b'')]})
+
+        self._read_url(server.url('/password'), data='secret',
+                       headers={'user-agent': 'test'})
+
+        method, _, headers, body = server.requests[0]
+        self.assertEqual('POST', method)
+        self.assertEqual('test', headers['user-agent'])
+        self.assertEqual(b'secret', body)
+
+    def test_read_url_chunked(self):
+        body = b'5\r\nhello\r\n6\r\n world\r\n0\r\n\r\n'
+        server = self._server({
+            '/': [(200, {'Transfer-Encoding': 'chunked'}, body)],
+        })
+
+        response = self._read_url(server.url('/'))
+
+        self.assertEqual(b'hello world', response.contents)
+
+    def test_read_url_redirect(self):
+        server = self._server({
+            '/old': [(302, {'Location': '/new'}, b'')],
+            '/new': [(200, {}, b'moved')],
+        })
+
+        response = self._read_url(server.url('/old'))
+
+        self.assertEqual(b'moved', response.contents)
+        self.assertEqual(server.url('/new'), response.url)
+
+    def test_read_url_redirect_not_allowed(self):
+        server = self._server({'/old': [(302, {'Location': '/new'}, b'')]})
+
+        response = self._read_url(server.url('/old'), allow_redirects=False)
+
+        self.assertEqual(302, response.status_code)
+        self.assertTrue(response.ok(redirects_ok=True))
+
+    def test_read_url_status_error(self):
+        server = self._server({})
+
+        exc = self.assertRaises(url_helper.UrlError, self._read_url,
+                                server.url('/missing'))
+
+        self.assertEqual(404, exc.status_code)
+
+    def test_read_url_no_check_status(self):
+        server = self._server({})
+
+        response = self._read_url(server.url('/missing'), check_status=False)
+
+        self.assertEqual(404, response.status_code)
+        self.assertFalse(response.ok())
+
+    def test_read_url_retries(self):
+        server = self._server({
+            '/': [(500, {}, b'no worky'), (200, {}, b'it worked!')],
+        })
+
+        response = self._read_url(server.url('/'), retries=2)
+
+        self.assertEqual(b'it worked!', response.contents)
+        self.assertEqual(2, len(server.requests))
+
+    def test_read_url_connection_error(self):
+        server = self._server({})
+        url = server.url('/')
+        server.__exit__()
+
+        exc = self.assertRaises(url_helper.UrlError, self._read_url, url,
+                                retries=1)
+
+        self.assertIsNone(exc.status_code)
+
+    def test_read_url_timeout(self):
+        async def slow():
+            await asyncio.sleep(5)
+            return b'too late'
+
+        server = self._server({'/': [(200, {}, slow)]})
+
+        exc = self.assertRaises(url_helper.UrlError, self._read_url,
+                                server.url('/'), timeout=0.1)
+
+        self.assertIsInstance(exc.cause, asyncio.TimeoutError)
+
+    def test_ssl_context(self):
+        with mock.patch('ssl.create_default_context') as mock_context:
+            context = async_url_helper._get_ssl_context(
+                {'ca_certs': 'ca', 'cert_file': 'cert', 'key_file': 'key'})
+
+        mock_context.assert_called_once_with(cafile='ca')
+        context.load_cert_chain.assert_called_once_with('cert', 'key')
+
+    def test_wait_any_url(self):
+        async def slow():
+            await asyncio.sleep(5)
+            return b'slow'
+
+        server = self._server({
+            '/slow': [(200, {}, slow)],
+            '/broken': [(500, {}, b'broken')],
+            '/fast': [(200, {}, b'fast')],
+        })
+        urls = [server.url('/slow'), server.url('/broken'),
+                server.url('/fast')]
+        status_cb = mock.Mock()
+
+        url, response = self.loop.run_until_complete(
+            async_url_helper.wait_any_url_async(urls, status_cb=status_cb))
+
+        self.assertEqual(server.url('/fast'), url)
+        self.assertEqual(b'fast', response.contents)
+
+    def test_wait_any_url_no_work(self):
+        server = self._server({'/broken': [(500, {}, b'broken')]})
+        exception_cb = mock.Mock()
+
+        result = self.loop.run_until_complete(
+            async_url_helper.wait_any_url_async(
+                [server.url('/broken'), server.url('/missing')],
+                max_wait=0, exception_cb=exception_cb))
+
+        self.assertIsNone(result)
+        codes = sorted(call[1]['exception'].status_code
+                       for call in exception_cb.call_args_list)
+        self.assertEqual([404, 500], codes)
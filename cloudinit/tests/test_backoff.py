@@ -0,0 +1,112 @@
+# Copyright 2015 Canonical Ltd.
+# This file is part of cloud-init.  See LICENCE file for license information.
+#
+# vi: ts=4 expandtab
+
+from cloudinit import backoff
+from cloudinit.tests import TestCase
+from cloudinit.tests.util import mock
+
+
+class FakeClock(object):
+
+    def __init__(self):
+        self.time = 100
+
+    def __call__(self):
+        return self.time
+
+
+class TestDeadline(TestCase):
+
+    def setUp(self):
+        super(TestDeadline, self).setUp()
+        self.clock = FakeClock()
+
+    def test_budget(self):
+        deadline = backoff.Deadline(10, clock=self.clock)
+        self.assertFalse(deadline.expired())
+        self.assertEqual(10, deadline.remaining())
+
+        self.clock.time += 4
+        self.assertEqual(4, deadline.elapsed())
+        self.assertEqual(6, deadline.remaining())
+        self.assertEqual(5, deadline.trim(5))
+        self.assertEqual(6, deadline.trim(10))
+        self.assertEqual(6, deadline.trim(None))
+
+        self.clock.time += 7
+        self.assertTrue(deadline.expired())
+        self.assertEqual(0, deadline.remaining())
+
+    def test_no_budget(self):
+        deadline = backoff.Deadline(clock=self.clock)
+        self.clock.time += 1000
+
+        self.assertFalse(deadline.expired())
+        self.assertIsNone(deadline.remaining())
+        self.assertEqual(5, deadline.trim(5))
+
+    def test_zero_budget(self):
+        deadline = backoff.Deadline(0, clock=self.clock)
+        self.assertTrue(deadline.expired())
+
+
+class TestBackoff(TestCase):
+
+    def test_no_jitter(self):
+        instance = backoff.Backoff(base=1, cap=5, jitter=backoff.NO_JITTER)
+        delays = [instance.next_delay() for _ in range(5)]
+        self.assertEqual([1, 2, 4, 5, 5], delays)
+
+        instance.reset()
+        self.assertEqual(1, instance.next_delay())
+
+    def test_full_jitter(self):
+        rand = mock.Mock(side_effect=lambda low, high: high / 2.0)
+        instance = backoff.Backoff(base=1, cap=5, rand=rand)
+        delays = [instance.next_delay() for _ in range(4)]
+
+        self.assertEqual([0.5, 1, 2, 2.5], delays)
+        rand.assert_called_with(0, 5)
+
+    def test_decorrelated_jitter(self):
+        rand = mock.Mock(side_effect=lambda low, high: high)
+        instance = backoff.Backoff(base=1, cap=20,
+                                   jitter=backoff.DECORRELATED_JITTER,
+                                   rand=rand)
+        delays = [instance.next_delay() for _ in range(4)]
+
+        self.assertEqual([3, 9, 20, 20], delays)
+        rand.assert_called_with(1, 60)
+
+    def test_jitter_is_random(self):
+        instance = backoff.Backoff(base=1, cap=100)
+        delays = set(instance.next_delay() for _ in range(20))
+        self.assertGreater(len(delays), 1)
+        self.assertTrue(all(0 <= delay <= 100 for delay in delays))
+
+    def test_invalid_jitter(self):
+        self.assertRaises(ValueError, backoff.Backoff, jitter='bogus')
+
+    def test_trimmed_by_deadline(self):
+        clock = FakeClock()
+        deadline = backoff.Deadline(3, clock=clock)
+        instance = backoff.Backoff(base=10, jitter=backoff.NO_JITTER,
+                                   deadline=deadline)
+
+        self.assertEqual(3, instance.next_delay())
+
+    @mock.patch('time.sleep')
+    def test_sleep(self, mock_sleep):
+        clock = FakeClock()
+        deadline = backoff.Deadline(3, clock=clock)
+        instance = backoff.Backoff(base=2, jitter=backoff.NO_JITTER,
+                                   deadline=deadline)
+
+        self.assertTrue(instance.sleep())
+        mock_sleep.assert_called_once_with(2)
+
+        clock.time += 5
+        self.assertFalse(instance.sleep())
+        self.assertEqual(1, mock_sleep.call_count)
@@ -0,0 +1,129 @@
+# Copyright 2015 Canonical Ltd.
+# This file is part of cloud-init.  See LICENCE file for license information.
+#
+# vi: ts=4 expandtab
+
+import fixtures
+
+from cloudinit.tests import http_server
+from cloudinit.tests import TestCase
+from cloudinit.tests.util import mock
+from cloudinit import url_cache
+from cloudinit import url_helper
+
+
+class ConditionalHTTPServer(http_server.LocalHTTPServer):
+    """Serves the metadata with an ETag, honouring If-None-Match."""
+
+    etag = '"v1"'
+    body = b'{"uuid": "fake"}'
+    broken = False
+
+    def respond(self, method, path, headers, body):
+        if self.broken:
+            return 503, {}, b'unavailable'
+        if path == '/no-validators':
+            return 200, {}, self.body
+        if headers.get('If-None-Match') == self.etag:
+            return 304, {'ETag': self.etag}, b''
+        return 200, {'ETag': self.etag,
+                     'Content-Type': 'application/json'}, self.body
+
+
+class TestHttpCache(TestCase):
+
+    def setUp(self):
+        super(TestHttpCache, self).setUp()
+        self.addCleanup(url_helper.close_sessions)
+        self.directory = self.useFixture(fixtures.TempDir()).path
+        self.cache = url_cache.HttpCache(self.directory)
+        self.server = ConditionalHTTPServer()
+        self.server.start()
+        self.addCleanup(self.server.stop)
+        self.url = self.server.url('/meta_data.json')
+
+    def test_not_modified_served_from_cache(self):
+        first = url_helper.read_url(self.url, cache=self.cache)
+        second = url_helper.read_url(self.url, cache=self.cache)
+
+        self.assertNotIsInstance(first, url_cache.CachedResponse)
+        self.assertIsInstance(second, url_cache.CachedResponse)
+        self.assertEqual(self.server.body, second.contents)
+        self.assertEqual('application/json', second.headers['content-type'])
+        self.assertTrue(second.ok())
+        self.assertEqual(2, len(self.server.requests))
+
+    def test_modified_is_refreshed(self):
+        url_helper.read_url(self.url, cache=self.cache)
+        self.server.etag = '"v2"'
+        self.server.body = b'{"uuid": "other"}'
+
+        response = url_helper.read_url(self.url, cache=self.cache)
+
+        self.assertEqual(b'{"uuid": "other"}', response.contents)
+        cached = self.cache.lookup(self.url)
+        self.assertEqual({'If-None-Match': '"v2"'}, cached.validators())
+        self.assertEqual(b'{"uuid": "other"}', cached.contents)
+
+    def test_stale_on_error(self):
+        url_helper.read_url(self.url, cache=self.cache)
+        self.server.broken = True
+
+        response = url_helper.read_url(self.url, cache=self.cache,
+                                       stale_on_error=True)
+
+        self.assertIsInstance(response, url_cache.CachedResponse)
+        self.assertEqual(self.server.body, response.contents)
+
+    def test_no_stale_on_error(self):
+        url_helper.read_url(self.url, cache=self.cache)
+        self.server.broken = True
+
+        exc = self.assertRaises(url_helper.UrlError, url_helper.read_url,
+                                self.url, cache=self.cache)
+        self.assertEqual(503, exc.status_code)
+
+    def test_stale_on_connection_error(self):
+        url_helper.read_url(self.url, cache=self.cache)
+        self.server.stop()
+        self.addCleanup(self.server.start)
+
+        response = url_helper.read_url(self.url, cache=self.cache,
+                                       stale_on_error=True, timeout=1)
+
+        self.assertEqual(self.server.body, response.contents)
+
+    def test_not_cacheable(self):
+        url = self.server.url('/no-validators')
+        url_helper.read_url(url, cache=self.cache)
+
+        self.assertIsNone(self.cache.lookup(url))
+
+    def test_no_store(self):
+        response = mock.Mock(status_code=200,
+                             headers={'ETag': '"v1"',
+                                      'Cache-Control': 'no-store'})
+        self.assertFalse(self.cache.store(self.url, response))
+
+    def test_wait_any_url_with_cache(self):
+        url_helper.wait_any_url([self.url], cache=self.cache)
+
+        url, response = url_helper.wait_any_url([self.url], cache=self.cache)
+
+        self.assertEqual(self.url, url)
+        self.assertIsInstance(response, url_cache.CachedResponse)
+
+    def test_remove(self):
+        url_helper.read_url(self.url, cache=self.cache)
+        self.cache.remove(self.url)
+        self.cache.remove(self.url)
+
+        self.assertIsNone(self.cache.lookup(self.url))
+
+    def test_store_failure_is_not_fatal(self):
+        cache = url_cache.HttpCache('/dev/null/impossible')
+
+        response = url_helper.read_url(self.url, cache=cache)
+
+        self.assertEqual(self.server.body, response.contents)
+        self.assertIsNone(cache.lookup(self.url))
@@ -3,8 +3,12 @@
 #
 # vi: ts=4 expandtab
 
+import io
+
 import httpretty
 
+from cloudinit import backoff
+from cloudinit.tests import http_server
 from cloudinit.tests import TestCase
 from cloudinit.tests.util import mock
 from cloudinit import url_helper
@@ -68,6 +72,96 @@ class UrlHelperWaitForUrlsTest(TestCase):
         self.assertIsNone(url_helper.wait_any_url(urls, max_wait=1))
 
 
+class UrlHelperWaitForUrlsRacingTest(TestCase):
+
+    def setUp(self):
+        super(UrlHelperWaitForUrlsRacingTest, self).setUp()
+        self.addCleanup(url_helper.close_sessions)
+        self.slow = http_server.LocalHTTPServer({'/': b'slow'}, latency=2)
+        self.fast = http_server.LocalHTTPServer({'/': b'fast'})
+        self.broken = http_server.LocalHTTPServer({'/': (500, b'broken')})
+        for server in (self.slow, self.fast, self.broken):
+            server.start()
+            self.addCleanup(server.stop)
+
+    def test_fastest_url_wins(self):
+        urls = [self.slow.url('/'), self.broken.url('/'), self.fast.url('/')]
+        start = url_helper.now()
+
+        url, response = url_helper.wait_any_url(urls, timeout=5,
+                                                concurrency=3)
+
+        self.assertEqual(self.fast.url('/'), url)
+        self.assertEqual(b'fast', response.contents)
+        self.assertLess(url_helper.now() - start, 2)
+
+    def test_failures_are_reported(self):
+        status_cb = mock.Mock()
+        exception_cb = mock.Mock()
+        urls = [self.broken.url('/'), self.fast.url('/missing')]
+
+        result = url_helper.wait_any_url(urls, max_wait=0, concurrency=2,
+                                         status_cb=status_cb,
+                                         exception_cb=exception_cb)
+
+        self.assertIsNone(result)
+        self.assertEqual(2, status_cb.call_count)
+        self.assertEqual(2, exception_cb.call_count)
+        codes = sorted(call[1]['exception'].status_code
+                       for call in exception_cb.call_args_list)
+        self.assertEqual([404, 500], codes)
+
+
+class UrlHelperDeadlineTest(TestCase):
+
+    def setUp(self):
+        super(UrlHelperDeadlineTest, self).setUp()
+        self.addCleanup(url_helper.close_sessions)
+        self.server = http_server.LocalHTTPServer({'/': (500, b'broken')})
+        self.server.start()
+        self.addCleanup(self.server.stop)
+
+    @mock.patch('time.sleep')
+    def test_shared_deadline(self, mock_sleep):
+        clock = mock.Mock(return_value=0)
+        deadline = backoff.Deadline(10, clock=clock)
+        schedule = backoff.Backoff(base=4, jitter=backoff.NO_JITTER)
+
+        def sleep(seconds):
+            clock.return_value += seconds
+
+        mock_sleep.side_effect = sleep
+
+        result = url_helper.wait_any_url([self.server.url('/')],
+                                         deadline=deadline,
+                                         backoff=schedule)
+
+        self.assertIsNone(result)
+        # 4 seconds, then the 8 seconds delay is trimmed to 6 seconds.
+        self.assertEqual([mock.call(4), mock.call(6)],
+                         mock_sleep.call_args_list)
+        self.assertEqual(3, len(self.server.requests))
+
+    def test_read_url_expired_deadline(self):
+        deadline = backoff.Deadline(0)
+
+        self.assertRaises(url_helper.UrlError, url_helper.read_url,
+                          self.server.url('/'), deadline=deadline)
+        self.assertEqual(0, len(self.server.requests))
+
+    @mock.patch.object(url_helper, '_SESSIONS')
+    def test_read_url_timeout_trimmed(self, mock_sessions):
+        deadline = backoff.Deadline(5)
+        session = mock_sessions.get.return_value
+        session.request.return_value.status_code = 200
+
+        url_helper.read_url(self.server.url('/'), timeout=10,
+                            deadline=deadline)
+
+        timeout = session.request.call_args[1]['timeout']
+        self.assertLessEqual(timeout, 5)
+
+
 class UrlHelperFetchTest(TestCase):
 
     @httpretty.activate
@@ -136,3 +230,123 @@ class UrlHelperFetchTest(TestCase):
         self.assertRaises(url_helper.UrlError,
                           url_helper.read_url, "http://www.yahoo.com",
                           retries=2)
+
+
+class UrlHelperSessionPoolTest(TestCase):
+
+    def setUp(self):
+        super(UrlHelperSessionPoolTest, self).setUp()
+        self.addCleanup(url_helper.close_sessions)
+        self.server = http_server.LocalHTTPServer({'/': b'it worked!'})
+        self.server.start()
+        self.addCleanup(self.server.stop)
+
+    def test_connection_reused(self):
+        for _ in range(5):
+            resp = url_helper.read_url(self.server.url('/'))
+            self.assertEqual(b'it worked!', resp.contents)
+
+        self.assertEqual(5, len(self.server.requests))
+        self.assertEqual(1, self.server.connections)
+
+    def test_close_sessions(self):
+        url_helper.read_url(self.server.url('/'))
+        url_helper.close_sessions()
+        url_helper.read_url(self.server.url('/'))
+
+        self.assertEqual(2, self.server.connections)
+
+    def test_pool_key(self):
+        self.assertEqual(('http', 'example.com', 80),
+                         url_helper._get_pool_key('http://example.com/a'))
+        self.assertEqual(('https', 'example.com', 443),
+                         url_helper._get_pool_key('https://Example.com/'))
+        self.assertEqual(('http', '10.0.0.1', 8080),
+                         url_helper._get_pool_key('http://10.0.0.1:8080/'))
+
+    def test_pool_is_bounded(self):
+        pool = url_helper._SessionPool(max_sessions=2)
+        first = pool.get('http://a.example.com/')
+        pool.get('http://b.example.com/')
+        self.assertIs(first, pool.get('http://a.example.com/x'))
+
+        with mock.patch.object(first, 'close') as mock_close:
+            pool.get('http://c.example.com/')
+            self.assertFalse(mock_close.called)
+            pool.get('http://c.example.com/', retries=3)
+            mock_close.assert_called_once_with()
+
+        self.assertEqual(2, len(pool))
+        pool.close()
+        self.assertEqual(0, len(pool))
+
+
+class UrlHelperStreamingTest(TestCase):
+
+    def setUp(self):
+        super(UrlHelperStreamingTest, self).setUp()
+        self.addCleanup(url_helper.close_sessions)
+        self.body = b'x' * (url_helper.CHUNK_SIZE * 3 + 10)
+        chunked = b''.join(b'%x\r\n%s\r\n' % (len(chunk), chunk)
+                           for chunk in (self.body[:10], self.body[10:]))
+        self.server = http_server.LocalHTTPServer({
+            '/user_data': self.body,
+            '/chunked': (200, {'Transfer-Encoding': 'chunked'},
+                         chunked + b'0\r\n\r\n'),
+        })
+        self.server.start()
+        self.addCleanup(self.server.stop)
+
+    def test_iter_contents(self):
+        response = url_helper.read_url(self.server.url('/user_data'),
+                                       stream=True)
+
+        chunks = list(response.iter_contents(chunk_size=1024))
+
+        self.assertEqual(self.body, b''.join(chunks))
+        self.assertEqual(1024, max(len(chunk) for chunk in chunks))
+
+    def test_write_to(self):
+        response = url_helper.read_url(self.server.url('/user_data'),
+                                       stream=True)
+        fileobj = io.BytesIO()
+
+        size = response.write_to(fileobj)
+
+        self.assertEqual(len(self.body), size)
+        self.assertEqual(self.body, fileobj.getvalue())
+
+    def test_contents(self):
+        response = url_helper.read_url(self.server.url('/chunked'),
+                                       max_size=len(self.body))
+
+        self.assertEqual(self.body, response.contents)
+        self.assertEqual(self.body.decode(), str(response))
+
+    def test_max_size_content_length(self):
+        exc = self.assertRaises(url_helper.UrlError, url_helper.read_url,
+                                self.server.url('/user_data'),
+                                max_size=1024)
+
+        self.assertEqual(url_helper.OK, exc.status_code)
+        self.assertIn('larger than the maximum allowed size', str(exc))
+
+    def test_max_size_streamed(self):
+        response = url_helper.read_url(self.server.url('/chunked'),
+                                       stream=True, max_size=1024)
+        chunks = response.iter_contents(chunk_size=10)
+
+        self.assertEqual(self.body[:10], next(chunks))
+        self.assertRaises(url_helper.UrlError, list, chunks)
+
+    def test_max_size_not_streamed(self):
+        self.assertRaises(url_helper.UrlError, url_helper.read_url,
+                          self.server.url('/chunked'), max_size=1024)
+
+    def test_connection_reused_after_streaming(self):
+        for _ in range(3):
+            response = url_helper.read_url(self.server.url('/user_data'),
+                                           stream=True)
+            response.write_to(io.BytesIO())
+
+        self.assertEqual(1, self.server.connections)
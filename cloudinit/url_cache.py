@@ -0,0 +1,161 @@
+# Copyright 2015 Canonical Ltd.
+# This file is part of cloud-init.  See LICENCE file for license information.
+#
+# vi: ts=4 expandtab
+
+"""An on-disk HTTP cache, revalidated with conditional requests.
+
+Responses carrying an ``ETag`` or a ``Last-Modified`` header are stored
+on disk by :func:`cloudinit.url_helper.read_url` (when it is given a
+cache), together with these validators. Later fetches of the same url
+send ``If-None-Match`` / ``If-Modified-Since`` headers, and a
+``304 Not Modified`` answer is served from the disk instead.
+"""
+
+import errno
+import hashlib
+import json
+import os
+import tempfile
+import time
+
+from requests import structures
+
+from cloudinit import logging
+from cloudinit import url_helper
+
+
+LOG = logging.getLogger(__name__)
+
+_KEPT_HEADERS = ('Content-Type', 'ETag', 'Last-Modified')
+
+
+class CachedResponse(object):
+    """A response served from a :class:`HttpCache`.
+
+    This has the same interface as :class:`cloudinit.url_helper.
+    RequestsResponse`, the body being read from the disk only when
+    it is needed.
+    """
+
+    from_cache = True
+
+    def __init__(self, url, headers, body_path, encoding=None):
+        self.url = url
+        self.headers = structures.CaseInsensitiveDict(headers)
+        self.encoding = encoding or 'utf-8'
+        self.status_code = url_helper.OK
+        self._body_path = body_path
+        self._contents = None
+
+    @property
+    def contents(self):
+        if self._contents is None:
+            with open(self._body_path, 'rb') as stream:
+                self._contents = stream.read()
+        return self._contents
+
+    def ok(self, redirects_ok=False):
+        return True
+
+    def validators(self):
+        """Get the headers to send for revalidating this response."""
+        validators = {}
+        if 'ETag' in self.headers:
+            validators['If-None-Match'] = self.headers['ETag']
+        if 'Last-Modified' in self.headers:
+            validators['If-Modified-Since'] = self.headers['Last-Modified']
+        return validators
+
+    def __str__(self):
+        return self.contents.decode(self.encoding, 'replace')
+
+
+class HttpCache(object):
+    """An on-disk cache of HTTP responses.
+
+    :param directory:
+        The directory where the responses are stored (it is
+        created when needed).
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def _paths(self, url):
+        key = hashlib.sha256(url.encode('utf-8')).hexdigest()
+        path = os.path.join(self.directory, key)
+        return path + '.json', path + '.body'
+
+    @staticmethod
+    def is_cacheable(response):
+        """Check if the given (fresh) *response* can be stored."""
+        if response.status_code != url_helper.OK:
+            return False
+        if 'no-store' in response.headers.get('Cache-Control', ''):
+            return False
+        return ('ETag' in response.headers or
+                'Last-Modified' in response.headers)
+
+    def lookup(self, url):
+        """Get the :class:`CachedResponse` stored for *url*, if any."""
+        meta_path, body_path = self._paths(url)
+        try:
+            with open(meta_path) as stream:
+                meta = json.load(stream)
+        except (IOError, OSError, ValueError):
+            return None
+        if meta.get('url') != url or not os.path.exists(body_path):
+            return None
+        return CachedResponse(url, meta.get('headers', {}), body_path,
+                              encoding=meta.get('encoding'))
+
+    def _write(self, path, content):
+        # Write it atomically, a partial entry is worse than none.
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory)
+        try:
+            with os.fdopen(fd, 'wb') as stream:
+                stream.write(content)
+            os.rename(tmp_path, path)
+        except Exception:
+            os.unlink(tmp_path)
+            raise
+
+    def store(self, url, response):
+        """Store the given *response* for *url*, if it can be revalidated.
+
+        Failing to store it is not fatal, the error is only logged.
+        """
+        if not self.is_cacheable(response):
+            return False
+        meta_path, body_path = self._paths(url)
+        headers = dict((name, response.headers[name])
+                       for name in _KEPT_HEADERS if name in response.headers)
+        meta = {
+            'url': url,
+            'headers': headers,
+            'encoding': getattr(response, 'encoding', None),
+            'stored_at': time.time(),
+        }
+        try:
+            try:
+                os.makedirs(self.directory)
+            except OSError as exc:
+                if exc.errno != errno.EEXIST:
+                    raise
+            self._write(body_path, response.contents)
+            self._write(meta_path, json.dumps(meta).encode('utf-8'))
+        except (IOError, OSError) as exc:
+            LOG.warning("Failed caching %s: %s", url, exc)
+            return False
+        LOG.debug("Cached %s (%s)", url, headers)
+        return True
+
+    def remove(self, url):
+        """Remove the entry stored for *url*, if any."""
+        for path in self._paths(url):
+            try:
+                os.unlink(path)
+            except OSError as exc:
+                if exc.errno != errno.ENOENT:
+                    raise
@@ -3,6 +3,9 @@
 #
 # vi: ts=4 expandtab
 
+import collections
+from concurrent import futures
+import threading
 import time
 
 try:
@@ -24,9 +27,12 @@ from six.moves.urllib.parse import urlunparse  # noqa
 
 from six.moves.http_client import BAD_REQUEST as _BAD_REQUEST
 from six.moves.http_client import CONFLICT  # noqa
+from six.moves.http_client import INTERNAL_SERVER_ERROR as _SERVER_ERROR
 from six.moves.http_client import MULTIPLE_CHOICES as _MULTIPLE_CHOICES
+from six.moves.http_client import NOT_MODIFIED as _NOT_MODIFIED
 from six.moves.http_client import OK
 
+from cloudinit import backoff as backoff_helper
 from cloudinit import logging
 from cloudinit import version
 
@@ -40,6 +46,21 @@ except ImportError:
 
 LOG = logging.getLogger(__name__)
 
+# Maximum number of sessions (one per scheme/host/port and retry
+# policy) kept alive by the process-wide session pool.
+MAX_POOLED_SESSIONS = 16
+
+# Maximum number of keep-alive connections kept around per host.
+MAX_POOLED_CONNECTIONS = 4
+
+# Size of the chunks in which streamed responses are read.
+CHUNK_SIZE = 64 * 1024
+
+_DEFAULT_PORTS = {
+    'http': 80,
+    'https': 443,
+}
+
 
 def _get_base_url(url):
     parsed_url = list(urlparse(url, scheme='http'))
@@ -57,42 +78,170 @@ def _clean_url(url):
     return urlunparse(parsed_url)
 
 
+def _get_pool_key(url):
+    parsed_url = urlparse(url, scheme='http')
+    scheme = parsed_url.scheme.lower()
+    port = parsed_url.port or _DEFAULT_PORTS.get(scheme)
+    return (scheme, parsed_url.hostname, port)
+
+
 class _Retry(urllib3_util.Retry):
     def is_forced_retry(self, method, status_code):
         # Allow >= 400 to be tried...
         return status_code >= _BAD_REQUEST
 
-    def sleep(self):
+    def sleep(self, response=None):
         # The base class doesn't have a way to log what we are doing,
-        # so replace it with one that does...
+        # so replace it with one that does (and that jitters the delays,
+        # so that many clients don't retry in lockstep)...
         backoff = self.get_backoff_time()
         if backoff <= 0:
             return
         else:
+            backoff = backoff_helper.full_jitter(backoff)
             LOG.debug("Please wait %s seconds while we wait to try again",
                       backoff)
             time.sleep(backoff)
 
 
+class _SessionPool(object):
+    """A bounded, process-wide pool of keep-alive ``requests`` sessions.
+
+    Sessions are keyed by the scheme, host and port of the url (and by the
+    retry policy mounted on them), so that consecutive requests made to the
+    same service reuse the already established connections instead of
+    paying a new TCP (and TLS) handshake for every request.
+
+    When more than *max_sessions* sessions are alive, the least recently
+    used one is closed.
+    """
+
+    def __init__(self, max_sessions=MAX_POOLED_SESSIONS,
+                 max_connections=MAX_POOLED_CONNECTIONS):
+        self.max_sessions = max_sessions
+        self.max_connections = max_connections
+        self._sessions = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def _make_session(self, url, retries, allow_redirects):
+        if retries:
+            max_retries = _Retry(total=retries,
+                                 raise_on_redirect=not allow_redirects)
+        else:
+            max_retries = 0
+        adapter = adapters.HTTPAdapter(pool_connections=1,
+                                       pool_maxsize=self.max_connections,
+                                       max_retries=max_retries)
+        session = requests.Session()
+        session.mount(_get_base_url(url), adapter)
+        return session
+
+    def get(self, url, retries=0, allow_redirects=True):
+        """Get the session to be used for fetching the given *url*."""
+        retries = max(int(retries or 0), 0)
+        key = _get_pool_key(url) + (retries, bool(allow_redirects))
+        with self._lock:
+            session = self._sessions.pop(key, None)
+            if session is None:
+                LOG.blather("Creating new session for %s", key)
+                session = self._make_session(url, retries, allow_redirects)
+            # Re-inserting marks it as the most recently used one.
+            self._sessions[key] = session
+            while len(self._sessions) > self.max_sessions:
+                _, old_session = self._sessions.popitem(last=False)
+                old_session.close()
+        return session
+
+    def close(self):
+        """Close all the pooled sessions (and their connections)."""
+        with self._lock:
+            while self._sessions:
+                _, session = self._sessions.popitem()
+                session.close()
+
+
+_SESSIONS = _SessionPool()
+
+
+def close_sessions():
+    """Close the connections kept alive by :func:`read_url`.
+
+    This should be called when the current stage no longer needs
+    to talk to any remote service.
+    """
+    _SESSIONS.close()
+
+
 class RequestsResponse(object):
     """A wrapper for requests responses (that provides common functions).
 
     This exists so that things like StringResponse or FileResponse can
     also exist, but with different sources of their response (aka not
     just from the requests library).
+
+    When the response is *streamed*, its body is not read until it is
+    asked for, either through :attr:`contents` or chunk by chunk,
+    through :meth:`iter_contents` or :meth:`write_to`. If *max_size*
+    is given, reading more than *max_size* bytes of body raises an
+    :class:`UrlError`.
     """
 
-    def __init__(self, response):
+    def __init__(self, response, stream=False, max_size=None):
         self._response = response
+        self._stream = stream
+        self._max_size = max_size
+        self._contents = None
 
     @property
     def contents(self):
-        return self._response.content
+        if not self._stream:
+            return self._response.content
+        if self._contents is None:
+            self._contents = b''.join(self.iter_contents())
+        return self._contents
+
+    def iter_contents(self, chunk_size=CHUNK_SIZE):
+        """Iterate over the body, in chunks of at most *chunk_size* bytes.
+
+        The body of a streamed response can be iterated only once.
+        """
+        size = 0
+        try:
+            for chunk in self._response.iter_content(chunk_size):
+                size += len(chunk)
+                if self._max_size is not None and size > self._max_size:
+                    self.close()
+                    raise _oversized_error(self._response, self._max_size)
+                yield chunk
+        except exceptions.RequestException as e:
+            raise UrlError(e, code=self.status_code, headers=self.headers)
+
+    def write_to(self, fileobj, chunk_size=CHUNK_SIZE):
+        """Write the body to the given file object, chunk by chunk.
+
+        This returns the number of bytes written.
+        """
+        size = 0
+        for chunk in self.iter_contents(chunk_size):
+            fileobj.write(chunk)
+            size += len(chunk)
+        return size
+
+    def close(self):
+        """Release the connection of a (partially read) streamed response."""
+        self._response.close()
 
     @property
     def url(self):
         return self._response.url
 
+    @property
+    def encoding(self):
+        return self._response.encoding or 'utf-8'
+
     def ok(self, redirects_ok=False):
         upper = _MULTIPLE_CHOICES
         if redirects_ok:
@@ -108,7 +257,9 @@ class RequestsResponse(object):
         return self._response.status_code
 
     def __str__(self):
-        return self._response.text
+        if not self._stream:
+            return self._response.text
+        return self.contents.decode(self.encoding, 'replace')
 
 
 class UrlError(IOError):
@@ -119,6 +270,13 @@ class UrlError(IOError):
         self.headers = headers or {}
 
 
+def _oversized_error(response, max_size):
+    cause = ValueError("Response from %s is larger than the maximum "
+                       "allowed size of %s bytes" % (response.url, max_size))
+    return UrlError(cause, code=response.status_code,
+                    headers=response.headers)
+
+
 def _get_ssl_args(url, ssl_details):
     ssl_args = {}
     scheme = urlparse(url).scheme
@@ -141,7 +299,9 @@ def _get_ssl_args(url, ssl_details):
 
 def read_url(url, data=None, timeout=None, retries=0,
              headers=None, ssl_details=None,
-             check_status=True, allow_redirects=True):
+             check_status=True, allow_redirects=True,
+             stream=False, max_size=None, cache=None,
+             stale_on_error=False, deadline=None):
     """Fetch a url (or post to one) with the given options.
 
     :param url: url to fetch
@@ -161,8 +321,35 @@ def read_url(url, data=None, timeout=None, retries=0,
     :param retries:
         maximum number of retries to attempt when fetching the url and
         the fetch fails
+    :param stream:
+        don't read the body of the response upfront, it can be read later
+        in chunks (see :meth:`RequestsResponse.iter_contents`), so that
+        the memory used is bounded by the size of a chunk
+    :param max_size:
+        maximum size (in bytes) of the response body; fetching (or
+        reading, when streaming) a larger body raises an
+        :class:`UrlError`, without reading the rest of the body
+    :param cache:
+        a :class:`cloudinit.url_cache.HttpCache`, where the (non
+        streamed) responses of GET requests are stored; cached responses
+        are revalidated with a conditional request and served from the
+        cache when the server answers with 304 (Not Modified)
+    :param stale_on_error:
+        serve the cached response (even if it could not be revalidated)
+        when the request fails or the server answers with an error
+    :param deadline:
+        a :class:`cloudinit.backoff.Deadline`; the timeout is trimmed to
+        the budget left and nothing is fetched if it already expired
+
+    Connections are kept alive between calls (see :func:`close_sessions`
+    for releasing them).
     """
     url = _clean_url(url)
+    if deadline is not None:
+        if deadline.expired():
+            raise UrlError(ValueError("Deadline of %ss expired before "
+                                      "fetching %s" % (deadline.budget, url)))
+        timeout = deadline.trim(timeout)
     request_args = {
         'url': url,
     }
@@ -181,32 +368,93 @@ def read_url(url, data=None, timeout=None, retries=0,
     if 'User-Agent' not in headers:
         headers['User-Agent'] = 'Cloud-Init/%s' % (version.version_string())
     request_args['headers'] = headers
-    session = requests.Session()
-    if retries:
-        retry = _Retry(total=max(int(retries), 0),
-                       raise_on_redirect=not allow_redirects)
-        session.mount(_get_base_url(url),
-                      adapters.HTTPAdapter(max_retries=retry))
+    request_args['stream'] = stream or max_size is not None
+    cached = None
+    if cache is not None and request_args['method'] == 'GET' and not stream:
+        cached = cache.lookup(url)
+        if cached is not None:
+            headers.update(cached.validators())
+    session = _SESSIONS.get(url, retries=retries,
+                            allow_redirects=allow_redirects)
     try:
-        with session:
-            response = session.request(**request_args)
-            if check_status:
-                response.raise_for_status()
+        response = session.request(**request_args)
+        if cached is not None:
+            if response.status_code == _NOT_MODIFIED:
+                LOG.debug("Read from %s (not modified, using the cached "
+                          "response)", url)
+                response.close()
+                return cached
+            if stale_on_error and response.status_code >= _SERVER_ERROR:
+                LOG.warning("Using the stale cached response for %s (%s)",
+                            url, response.status_code)
+                response.close()
+                return cached
+        if check_status:
+            response.raise_for_status()
     except exceptions.RequestException as e:
+        if cached is not None and stale_on_error:
+            LOG.warning("Using the stale cached response for %s (%s)",
+                        url, e)
+            return cached
         if e.response is not None:
+            e.response.close()
             raise UrlError(e, code=e.response.status_code,
                            headers=e.response.headers)
         else:
             raise UrlError(e)
+
+    if max_size is not None:
+        length = response.headers.get('Content-Length')
+        if length and length.isdigit() and int(length) > max_size:
+            response.close()
+            raise _oversized_error(response, max_size)
+    result = RequestsResponse(response, stream=request_args['stream'],
+                              max_size=max_size)
+    if stream:
+        LOG.debug("Streaming from %s (%s, %sb)", url, response.status_code,
+                  response.headers.get('Content-Length', '?'))
     else:
         LOG.debug("Read from %s (%s, %sb)", url, response.status_code,
-                  len(response.content))
-        return RequestsResponse(response)
+                  len(result.contents))
+        if cache is not None and request_args['method'] == 'GET':
+            cache.store(url, result)
+    return result
+
+
+def _check_url(url, timeout, **kwargs):
+    """Fetch the given *url* for :func:`wait_any_url`.
+
+    This returns a tuple of the response (if the url responded correctly),
+    the reason for failing and the exception describing the failure.
+    The keyword arguments are passed to :func:`read_url`.
+    """
+    try:
+        response = read_url(url, timeout=timeout, check_status=False,
+                            **kwargs)
+    except UrlError as e:
+        return None, "request error [%s]" % e, e
+    except Exception as e:
+        return None, "unexpected error [%s]" % e, e
+    return _check_response(response)
+
+
+def _check_response(response):
+    """Check that the *response* is usable by :func:`wait_any_url`."""
+    if not response.contents:
+        reason = "empty response [%s]" % (response.status_code)
+    elif not response.ok():
+        reason = "bad status code [%s]" % (response.status_code)
+    else:
+        return response, None, None
+    url_exc = UrlError(ValueError(reason), code=response.status_code,
+                       headers=response.headers)
+    return None, reason, url_exc
 
 
 def wait_any_url(urls, max_wait=None, timeout=None,
                  status_cb=None, sleep_time=1,
-                 exception_cb=None):
+                 exception_cb=None, concurrency=1, cache=None,
+                 stale_on_error=False, deadline=None, backoff=None):
     """Wait for one of many urls to respond correctly.
 
     :param urls: a list of urls to try
@@ -218,6 +466,22 @@ def wait_any_url(urls, max_wait=None, timeout=None,
         call method with 2 arguments 'msg' (per status_cb) and
         'exception', the exception that occurred.
     :param sleep_time: how long to sleep before trying each url again
+    :param concurrency:
+        how many urls can be tried at the same time. When this is greater
+        than one, all the urls are raced against each other (on a bounded
+        pool of threads) and the first one which responds correctly wins,
+        the slower ones being ignored. The callbacks are still called
+        from the calling thread.
+    :param cache: the cache provided to ``read_url``
+    :param stale_on_error: provided to ``read_url``, along with the cache
+    :param deadline:
+        a :class:`cloudinit.backoff.Deadline`, used instead of *max_wait*;
+        it can be shared with other calls, all of them drawing from the
+        same time budget
+    :param backoff:
+        a :class:`cloudinit.backoff.Backoff`, giving the delays between
+        the rounds of tries (instead of the default, slowly growing and
+        not jittered, delays)
 
     The idea of this routine is to wait for the EC2 metdata service to
     come up. On both Eucalyptus and EC2 we have seen the case where
@@ -237,7 +501,10 @@ def wait_any_url(urls, max_wait=None, timeout=None,
     This will return a tuple of the first url which succeeded and the
     response object.
     """
-    start_time = now()
+    if deadline is None:
+        deadline = backoff_helper.Deadline(max_wait or 0, clock=now)
+    else:
+        max_wait = deadline.budget
 
     def log_status_cb(msg, exc=None):
         LOG.debug(msg)
@@ -245,63 +512,93 @@ def wait_any_url(urls, max_wait=None, timeout=None,
     if not status_cb:
         status_cb = log_status_cb
 
-    def timeup(max_wait, start_time):
-        current_time = now()
-        return ((max_wait <= 0 or max_wait is None) or
-                (current_time - start_time > max_wait))
+    def report_failure(url, reason, url_exc):
+        time_taken = int(deadline.elapsed())
+        status_msg = "Calling '%s' failed [%s/%ss]: %s" % (url,
+                                                           time_taken,
+                                                           max_wait,
+                                                           reason)
+        status_cb(status_msg)
+        if exception_cb:
+            exception_cb(msg=status_msg, exception=url_exc)
+
+    def shorten_timeout(timeout):
+        # shorten timeout to not run way over the deadline (unless it
+        # already passed, in which case this is the one attempt left).
+        if deadline.expired():
+            return timeout
+        return deadline.trim(timeout)
+
+    def race(urls, timeout, loop_n):
+        # The first round waits for all the urls, as the serial
+        # mode does, the next ones are bounded by the deadline.
+        wait = None
+        if loop_n != 0:
+            wait = deadline.remaining()
+        pending = dict((executor.submit(_check_url, url, timeout,
+                                        **read_kwargs), url)
+                       for url in urls)
+        try:
+            for future in futures.as_completed(pending, timeout=wait):
+                url = pending[future]
+                response, reason, url_exc = future.result()
+                if response is not None:
+                    return url, response
+                report_failure(url, reason, url_exc)
+        except futures.TimeoutError:
+            LOG.debug("Gave up waiting for %s urls",
+                      len([future for future in pending
+                           if not future.done()]))
+        return None
+
+    read_kwargs = {}
+    if cache is not None:
+        read_kwargs.update(cache=cache, stale_on_error=stale_on_error)
+
+    executor = None
+    if concurrency > 1 and len(urls) > 1:
+        executor = futures.ThreadPoolExecutor(
+            max_workers=min(concurrency, len(urls)))
 
     loop_n = 0
-    while True:
-        # This makes a backoff with the following graph:
-        #
-        # https://www.desmos.com/calculator/c8pwjy6wmt
-        sleep_time = int(loop_n / 5) + 1
-        for url in urls:
-            current_time = now()
-            if loop_n != 0:
-                if timeup(max_wait, start_time):
+    try:
+        while True:
+            if backoff is not None:
+                sleep_time = deadline.trim(backoff.next_delay())
+            else:
+                # This makes a backoff with the following graph:
+                #
+                # https://www.desmos.com/calculator/c8pwjy6wmt
+                sleep_time = int(loop_n / 5) + 1
+            if executor is not None:
+                if loop_n != 0 and deadline.expired():
                     break
-                if (timeout and
-                        (current_time + timeout > (start_time + max_wait))):
-                    # shorten timeout to not run way over max_time
-                    timeout = int((start_time + max_wait) - current_time)
-            reason = ""
-            url_exc = None
-            try:
-                response = read_url(url, timeout=timeout, check_status=False)
-                if not response.contents:
-                    reason = "empty response [%s]" % (response.code)
-                    url_exc = UrlError(ValueError(reason), code=response.code,
-                                       headers=response.headers)
-                elif not response.ok():
-                    reason = "bad status code [%s]" % (response.code)
-                    url_exc = UrlError(ValueError(reason), code=response.code,
-                                       headers=response.headers)
-                else:
-                    return url, response
-            except UrlError as e:
-                reason = "request error [%s]" % e
-                url_exc = e
-            except Exception as e:
-                reason = "unexpected error [%s]" % e
-                url_exc = e
-
-            current_time = now()
-            time_taken = int(current_time - start_time)
-            status_msg = "Calling '%s' failed [%s/%ss]: %s" % (url,
-                                                               time_taken,
-                                                               max_wait,
-                                                               reason)
-            status_cb(status_msg)
-            if exception_cb:
-                exception_cb(msg=status_msg, exception=url_exc)
-
-        if timeup(max_wait, start_time):
-            break
-
-        loop_n = loop_n + 1
-        LOG.debug("Please wait %s seconds while we wait to try again",
-                  sleep_time)
-        time.sleep(sleep_time)
+                timeout = shorten_timeout(timeout)
+                result = race(urls, timeout, loop_n)
+                if result is not None:
+                    return result
+
+            else:
+                for url in urls:
+                    if loop_n != 0 and deadline.expired():
+                        break
+                    timeout = shorten_timeout(timeout)
+                    response, reason, url_exc = _check_url(url, timeout,
+                                                           **read_kwargs)
+                    if response is not None:
+                        return url, response
+                    report_failure(url, reason, url_exc)
+
+            if deadline.expired():
+                break
+
+            loop_n = loop_n + 1
+            LOG.debug("Please wait %s seconds while we wait to try again",
+                      sleep_time)
+            time.sleep(sleep_time)
+    finally:
+        if executor is not None:
+            # Don't wait for the slower urls, their results are ignored.
+            executor.shutdown(wait=False)
 
     return None